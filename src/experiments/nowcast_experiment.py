@@ -53,9 +53,9 @@ class NowcastExperiment:
     Provides instances for the experiment; can be overridden in unit tests.
     """
 
-    def get_data_source(self, epidata, sensors, locations, target):
+    def get_data_source(self, epidata, sensors, locations, target, cache_dir=None):
       """Return a DatasetnameDataSource instance."""
-      return DatasetnameDataSource(epidata, sensors, locations, target)
+      return DatasetnameDataSource(epidata, sensors, locations, target, cache_dir)
 
     def get_nowcast(self, data_source, cov_impl):
       """Return a Nowcast instance."""
@@ -73,15 +73,20 @@ class NowcastExperiment:
   MIN_OBSERVATIONS = 5
 
   @staticmethod
-  def new_instance(target="ov_datasetname_broad"):
+  def new_instance(target="ov_datasetname_broad", cache_dir=None):
     """Return a production-ready instance."""
     return NowcastExperiment(
-        NowcastExperiment.Provider(), Epidata, DatasetnameDataSource.new_instance(target))
+        NowcastExperiment.Provider(),
+        Epidata,
+        DatasetnameDataSource.new_instance(target, cache_dir),
+        cache_dir)
 
-  def __init__(self, provider, epidata, data_source):
+  def __init__(self, provider, epidata, data_source, cache_dir=None):
     self.provider = provider
     self.epidata = epidata
     self.data_source = data_source
+    # directory in which prefetched data is saved between experiments, if any
+    self.cache_dir = cache_dir
 
   @staticmethod
   def get_locations_at_resolution(resolution):
@@ -232,7 +237,11 @@ class NowcastExperiment:
 
     # prefetch bulk data
     data_source = self.provider.get_data_source(
-        self.epidata, sensors, locations)
+        self.epidata,
+        sensors,
+        locations,
+        self.data_source.target,
+        cache_dir=self.cache_dir)
     data_source.prefetch(max(weeks))
 
     # compute the nowcasts
@@ -272,6 +281,9 @@ def get_argument_parser():
       default=None,
       action='store_true',
       help='a control; unmodified operational nowcasting')
+  parser.add_argument(
+      '--cache-dir',
+      help='save prefetched data to (and load it from) this directory')
   return parser
 
 
@@ -285,10 +297,11 @@ def validate_args(args):
   return [args.filename] + values
 
 
-def main(*args):
+def main(*args, cache_dir=None):
   """Run this script from the command line."""
-  NowcastExperiment.new_instance().run_experiment(*args)
+  NowcastExperiment.new_instance(cache_dir=cache_dir).run_experiment(*args)
 
 
 if __name__ == '__main__':
-  main(*validate_args(get_argument_parser().parse_args()))
+  args = get_argument_parser().parse_args()
+  main(*validate_args(args), cache_dir=args.cache_dir)
@@ -16,6 +16,7 @@ output space.
 """
 
 # standard library
+from collections import OrderedDict
 from fractions import Fraction
 import functools
 
@@ -28,17 +29,78 @@ from delphi.utils.geo.locations import Locations
 from delphi.utils.geo.populations import get_population
 
 
+# atoms whose populations are given in terms of their components
+_ATOM_COMPONENTS = {'ny': ('ny_minus_jfk', 'jfk')}
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_population(location, season):
+  """Return the (cached) population of the given location in the season."""
+  if season:
+    return get_population(location, season)
+  return get_population(location)
+
+
+@functools.lru_cache(maxsize=512)
+def _get_region_set(location):
+  """Return the (cached) set of locations contained within the location."""
+  return frozenset(Locations.region_map[location])
+
+
 class DatasetnameLocationMapper:
   """Prepares for sensor fusion of signals based on US regions and states."""
 
-  __known_statespace = {}
+  # recently determined statespaces, keyed by population matrices; the least
+  # recently used entry is evicted beyond KNOWN_STATESPACE_SIZE entries
+  KNOWN_STATESPACE_SIZE = 64
+  __known_statespace = OrderedDict()
 
   @staticmethod
-  def get_weight_row(location, season, atoms):
+  @functools.lru_cache(maxsize=16)
+  def get_atom_populations(season, atoms):
     """
-    Return a list of the population weights of all atoms, with respect to the
-    given location. Atoms not within the location will have a weight of zero.
-    The returned weights will sum to one.
+    Return a read-only vector of the populations of the given atoms, along with
+    a list of the location components that make up each atom. Populations are
+    given per component, so the vector is aligned with the concatenation of the
+    component lists.
+    """
+
+    components = tuple(_ATOM_COMPONENTS.get(atom, (atom,)) for atom in atoms)
+    populations = []
+    # Remap season to the earliest season with 'pr' assigned a weight in
+    # delphi.utils.geo.populations:
+    remapped_season = max(season, 2013) if season else None
+    for atom_components in components:
+      for component in atom_components:
+        populations.append(_get_population(component, remapped_season))
+    populations = np.array(populations, dtype=np.int64)
+    populations.flags.writeable = False
+    return populations, components
+
+  @staticmethod
+  def get_membership_matrix(locations, components):
+    """
+    Return a 0/1 matrix, where rows correspond to the given locations and
+    columns correspond to the given location components. An entry is one iff
+    the component is contained within the location.
+    """
+
+    # visit only the members of each region, not every component
+    columns = {}
+    for col, component in enumerate(components):
+      columns.setdefault(component, []).append(col)
+    M = np.zeros((len(locations), len(components)), dtype=np.uint8)
+    for row, location in enumerate(locations):
+      for member in _get_region_set(location) & columns.keys():
+        M[row, columns[member]] = 1
+    return M
+
+  @staticmethod
+  def get_population_matrix(locations, season, atoms):
+    """
+    Return a matrix of (integer) populations, where rows correspond to the
+    given locations and columns correspond to the given atomic locations. Atoms
+    not within a location will have a population of zero in that row.
     """
 
     # IMPL: assign weights appropriately for datasetname. Below code is for a
@@ -57,47 +119,70 @@ class DatasetnameLocationMapper:
     # datasetname_location_mapper.py, is based on cmu-delphi/utils,
     # src/geo/locations.py.)
 
-    # check each atom individually
-    total_population = 0
-    atom_populations = []
-    for atom in atoms:
-      remapped_atom_to_atoms = ['ny_minus_jfk','jfk'] if atom=='ny' else [atom]
-      population = 0
-      for remapping_atom in remapped_atom_to_atoms:
-        if remapping_atom in Locations.region_map[location]:
-          if season:
-            # Remap season to the earliest season with 'pr' assigned a weight in
-            # delphi.utils.geo.populations:
-            remapped_season = max(season, 2013)
-            population += get_population(remapping_atom, remapped_season)
-          else:
-            population += get_population(remapping_atom)
-        else:
-          population += 0
-      total_population += population
-      atom_populations.append(population)
+    # populations of each component of each atom (e.g. 'ny' is split in two)
+    populations, components = DatasetnameLocationMapper.get_atom_populations(
+        season, tuple(atoms))
+    flat_components = [c for atom_components in components for c in atom_components]
+    M = DatasetnameLocationMapper.get_membership_matrix(locations, flat_components)
+    component_populations = M * populations
+
+    # sum the components of each atom
+    starts = np.cumsum([0] + [len(c) for c in components[:-1]])
+    atom_populations = np.add.reduceat(component_populations, starts, axis=1)
 
     # sanity check
-    if total_population == 0:
+    totals = atom_populations.sum(axis=1)
+    if np.any(totals == 0):
+      location = locations[int(np.flatnonzero(totals == 0)[0])]
       raise Exception(('location has no constituent atoms', location))
 
-    # return list of fractional populations
-    get_fraction = lambda pop: Fraction(pop, total_population)
-    return list(map(get_fraction, atom_populations))
+    return atom_populations
 
   @staticmethod
-  def get_weight_matrix(locations, season, atoms):
+  def get_weight_row(location, season, atoms):
+    """
+    Return a list of the population weights of all atoms, with respect to the
+    given location. Atoms not within the location will have a weight of zero.
+    The returned weights will sum to one.
+    """
+    matrix = DatasetnameLocationMapper.get_weight_matrix
+    return list(matrix((location,), season, atoms, exact=True)[0])
+
+  @staticmethod
+  def get_weight_matrix(locations, season, atoms, exact=False):
     """
     Return a matrix of weights, where rows correspond to the given locations
     and columns correspond to the given atomic locations.
+
+    By default, weights are floats. If `exact` is True, weights are instead
+    Fractions, which is needed for the exact arithmetic in
+    `fusion.determine_statespace`.
     """
 
-    # stack rows for each location and return the matrix
-    get_row = lambda loc: DatasetnameLocationMapper.get_weight_row(loc, season, atoms)
-    return np.array(list(map(get_row, locations)))
+    atom_populations = DatasetnameLocationMapper.get_population_matrix(
+        locations, season, atoms)
+    return DatasetnameLocationMapper.normalize_populations(atom_populations, exact)
+
+  @staticmethod
+  def normalize_populations(atom_populations, exact=False):
+    """
+    Return a matrix of weights by normalizing each row of the given population
+    matrix to sum to one. See `get_weight_matrix`.
+    """
+
+    totals = atom_populations.sum(axis=1, keepdims=True)
+    if not exact:
+      return atom_populations / totals
+
+    # most weights are zero, and Fractions are immutable, so share one instance
+    # and only construct Fractions for the nonzero numerators
+    zero = Fraction(0)
+    W = np.full(atom_populations.shape, zero, dtype=object)
+    for row, col in zip(*np.nonzero(atom_populations)):
+      W[row, col] = Fraction(int(atom_populations[row, col]), int(totals[row, 0]))
+    return W
 
   @staticmethod
-  @functools.lru_cache(maxsize=16)
   def determine_statespace(
       input_locations,
       # base_locations,
@@ -110,7 +195,9 @@ class DatasetnameLocationMapper:
     fusion kernel. A list of output locations corresponding to the rows of W is
     also returned.
 
-    Results are cached for better performance.
+    Results are cached for better performance. The cache is keyed on the set
+    of input locations (rather than on their order and multiplicity), so that
+    all orderings of the same inputs share a single cache entry.
 
     inputs:
       input_locations: a tuple of sensor locations
@@ -130,32 +217,69 @@ class DatasetnameLocationMapper:
     """
 
     # quick sanity check
-    if set(exclude_locations) & set(input_locations):
+    input_set = frozenset(input_locations)
+    if not input_set.isdisjoint(exclude_locations):
       raise Exception('input contains excluded locations')
 
     # function to filter out excluded atoms
     atom_filter = lambda a: a not in exclude_locations
 
     # list of all locations, including nat, hhs, cen, and atoms
-    all_locations = list(filter(atom_filter, data_source.ALL_LOCATIONS))
+    all_locations = tuple(filter(atom_filter, data_source.ALL_LOCATIONS))
 
     # list of atomic locations only
-    atoms = list(filter(atom_filter, data_source.ATOMIC_LOCATIONS))
+    atoms = tuple(filter(atom_filter, data_source.ATOMIC_LOCATIONS))
+
+    # statespace depends only on the set of inputs, so compute it once for the
+    # unique, sorted inputs and then expand H to match the given inputs
+    unique_locations = tuple(sorted(input_set))
+    has_all_atoms = input_set.issuperset(atoms)
+    H, W, output_locations = DatasetnameLocationMapper._determine_statespace(
+        unique_locations, atoms, all_locations, season, has_all_atoms)
+    rows = [unique_locations.index(loc) for loc in input_locations]
+    return H[rows, :], W, list(output_locations)
+
+  @staticmethod
+  @functools.lru_cache(maxsize=256)
+  def _determine_statespace(
+      input_locations, atoms, all_locations, season, has_all_atoms):
+    """
+    Return H, W, and output locations for the given (unique) input locations,
+    atoms, and output locations. `has_all_atoms` tells whether the input
+    locations include every atom. See `determine_statespace`.
+    """
 
     # precursors of the H and W matrices, assuming that statespace is US atoms
-    get_matrix = lambda locs: DatasetnameLocationMapper.get_weight_matrix(locs, season, atoms)
-    H0 = get_matrix(input_locations)
-    W0 = get_matrix(all_locations)
+    get_matrix = lambda locs, exact: DatasetnameLocationMapper.get_weight_matrix(
+        locs, season, atoms, exact=exact)
 
     # optimization for the typical case where all US atoms are represented
-    if set(input_locations) >= set(atoms):
+    if has_all_atoms:
       # statespace is all US atoms, so H and W are already correct
-      H, W, output_locations = H0, W0, all_locations
+      H = get_matrix(input_locations, False)
+      W = get_matrix(all_locations, False)
+      output_locations = all_locations
     else:
-      # determine optimal H and W matrices
-      H, W, selected_rows = fusion.determine_statespace(H0, W0)
+      # The optimal H and W matrices depend only on the population matrices,
+      # which are often identical across seasons and sets of inputs, so reuse
+      # a previously determined statespace when possible.
+      get_populations = lambda locs: DatasetnameLocationMapper.get_population_matrix(
+          locs, season, atoms)
+      H_pop, W_pop = get_populations(input_locations), get_populations(all_locations)
+      key = (H_pop.shape, H_pop.tobytes(), W_pop.shape, W_pop.tobytes())
+      known_statespace = DatasetnameLocationMapper.__known_statespace
+      if key in known_statespace:
+        known_statespace.move_to_end(key)
+      else:
+        # determine optimal H and W matrices; this requires exact arithmetic
+        normalize = DatasetnameLocationMapper.normalize_populations
+        H0, W0 = normalize(H_pop, exact=True), normalize(W_pop, exact=True)
+        known_statespace[key] = fusion.determine_statespace(H0, W0)
+        if len(known_statespace) > DatasetnameLocationMapper.KNOWN_STATESPACE_SIZE:
+          known_statespace.popitem(last=False)
+      H, W, selected_rows = known_statespace[key]
       # select the output locations
-      output_locations = [all_locations[i] for i in selected_rows]
+      output_locations = tuple(all_locations[i] for i in selected_rows)
 
     # convert fractions to floats and return the result
-    return H.astype(np.float), W.astype(np.float), output_locations
+    return H.astype(np.float64, copy=False), W.astype(np.float64, copy=False), output_locations
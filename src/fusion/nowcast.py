@@ -51,7 +51,7 @@ class DataSource(abc.ABC):
 
   @abc.abstractmethod
   def get_weeks(self):
-    """Return a list of weeks on which truth and sensors are both available."""
+    """Return a sequence of weeks on which truth and sensors are both available."""
 
   @abc.abstractmethod
   def get_truth_value(self, epiweek, location):
@@ -35,6 +35,7 @@ See also:
 
 # standard library
 import argparse
+import functools
 
 # third party
 import numpy as np
@@ -43,12 +44,21 @@ import numpy as np
 from delphi.epidata.client.delphi_epidata import Epidata
 import delphi.operations.secrets as secrets
 import delphi.utils.epiweek as EW
-from delphi.nowcast_datasetname.util.datasetname_data_source import DatasetnameDataSource
+from delphi.nowcast_datasetname.util.datasetname_data_source import DatasetnameDataSource, get_ground_truth
 
-def mutate_rows_as_if_lagged(rows, lag):
-  for row in rows:
-    row.update({'lag': lag})
-  return rows
+# memoized epiweek helpers; these are pure functions of a small domain
+_split_epiweek = functools.lru_cache(maxsize=4096)(EW.split_epiweek)
+_get_num_weeks = functools.lru_cache(maxsize=64)(EW.get_num_weeks)
+
+
+@functools.lru_cache(maxsize=4096)
+def get_holiday_indicators(ew):
+  """
+  Return a tuple of 4 indicators, one for each of this and the following 3
+  epiweeks, of whether that epiweek is the first week of the year. The result
+  is cached since it is shared by all ISCH instances.
+  """
+  return tuple(_split_epiweek(EW.add_epiweeks(ew, holiday))[1] == 1 for holiday in range(4))
 
 
 class ISCH:
@@ -63,11 +73,10 @@ class ISCH:
   def __init__(self, region, target):
     self.region = region
     self.target = target
+    self.model, self.training_week = None, None
     weeks = Epidata.range(199301, 202330)
-    auth = secrets.api.datasetname_targets
-    rx = mutate_rows_as_if_lagged(Epidata.check(Epidata.datasetname_targets(auth, self.target, self.region, weeks)), 1000000)
-    self.data = {}
-    self.valid = {}
+    # the target table is shared with (and cached for) the other sensors
+    ground_truth = get_ground_truth(self.target, self.region)
     self.ew2i, self.i2ew = {}, {}
     for ew in EW.range_epiweeks(weeks['from'], weeks['to'], inclusive=True):
       # if 200916 <= ew <= 201015:
@@ -75,36 +84,33 @@ class ISCH:
       i = len(self.ew2i)
       self.ew2i[ew] = i
       self.i2ew[i] = ew
-    for row in rx:
-      ew, observation, lag = row['epiweek'], row['value'], row['lag']
+    # stable observations, indexed like epiweeks; NaN where unavailable
+    self.stable = np.full(len(self.ew2i), np.nan)
+    for ew, observation in ground_truth.items():
       if ew not in self.ew2i:
         continue
-      i = self.ew2i[ew]
-      if i not in self.data:
-        self.data[i] = {}
-        self.valid[i] = {'stable': False}
-      lag = 'stable'
-      self.data[i][lag] = observation
-      self.valid[i][lag] = True
-    self.weeks = sorted(list(self.data.keys()))
-    for i in self.weeks:
-      if 'stable' not in self.data[i]:
-        continue
+      self.stable[self.ew2i[ew]] = observation
+    self.valid = np.isfinite(self.stable)
+    self.weeks = np.flatnonzero(self.valid).tolist()
+    # features only depend on the epiweek, so compute them once for all weeks
+    self.features = ISCH._build_feature_matrix(
+        [self.i2ew[i] for i in range(len(self.i2ew))])
+    self.features.flags.writeable = False
+
+  @staticmethod
+  def _build_feature_matrix(ews):
+    """Return a matrix with one row of features for each of the given epiweeks."""
+    years, weeks = zip(*[_split_epiweek(ew) for ew in ews])
+    N = np.array([_get_num_weeks(y) for y in years])
+    offset = np.pi * 2 * np.array(weeks) / N
+    holidays = np.array([get_holiday_indicators(ew) for ew in ews], dtype=np.float64)
+    intercept = np.ones((len(ews), 1))
+    # todo linear time trend covariate?
+    return np.hstack((intercept, holidays, np.sin(offset)[:, None], np.cos(offset)[:, None]))
 
   def _get_features(self, ew, valid=True):
-    X = np.zeros((1, 7))
     i = self.ew2i[ew]
-    X[0, 0] = 1
-    for holiday in range(4):
-      if EW.split_epiweek(EW.add_epiweeks(ew, holiday))[1] == 1:
-        X[0, 1 + holiday] = 1
-    y, w = EW.split_epiweek(ew)
-    N = EW.get_num_weeks(y)
-    offset = np.pi * 2 * w / N
-    X[0, 5] = np.sin(offset)
-    X[0, 6] = np.cos(offset)
-    # todo linear time trend covariate?
-    return X
+    return self.features[i:i + 1, :]
 
   def train(self, epiweek):
     if epiweek not in self.ew2i:
@@ -114,13 +120,9 @@ class ISCH:
     if i2 < i1:
       raise Exception('The available data are too "fresh"; all are being cut off for being too recent (or maybe even intersecting with the test time); at least {} additional observation(s) are needed for the training window to not cut them all off.'.format(i1-i2))
     ew1, ew2 = self.i2ew[i2], self.i2ew[i2]
-    num_weeks = i2 - i1 + 1
-    X, Y = np.zeros((num_weeks, 7)), np.zeros((num_weeks, 1))
-    r = 0
-    for i in range(i1, i2 + 1):
-      X[r, :] = self._get_features(self.i2ew[i], valid=False)
-      Y[r, 0] = self.data[i + 1]['stable']
-      r += 1
+    X, Y = self.features[i1:i2 + 1, :], self.stable[i1 + 1:i2 + 2, None]
+    if not np.all(self.valid[i1 + 1:i2 + 2]):
+      raise Exception('missing observations within the training window')
     # rule of thumb: require num training instances >= 10x num features and >= 52
     min_training_instances = max(10*X.shape[1], 52)
     if X.shape[0] < min_training_instances:
@@ -131,12 +133,13 @@ class ISCH:
     max_training_instances = 50*X.shape[1]
     X = X[-max_training_instances:,]
     Y = Y[-max_training_instances:,]
-    self.model = ISCH.dot(np.linalg.inv(ISCH.dot(X.T, X)), X.T, Y)
+    self.model = np.linalg.solve(ISCH.dot(X.T, X), ISCH.dot(X.T, Y))
     self.training_week = epiweek
     return (X, Y, self.model)
 
   def predict(self, epiweek, train=True, valid=True):
-    if train:
+    if train and self.training_week != epiweek:
+      # the model only depends on the training week, so retrain only as needed
       self.train(epiweek)
     if self.training_week > epiweek:
       raise Exception('trained on future data')
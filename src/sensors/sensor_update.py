@@ -28,6 +28,7 @@ See also:
 """
 # standard library
 import argparse
+import functools
 import re
 import subprocess
 import sys
@@ -38,13 +39,16 @@ import numpy as np
 # first party
 from delphi.epidata.client.delphi_epidata import Epidata
 from delphi.nowcast_datasetname.sensors.isch import ISCH
-from delphi.nowcast_datasetname.util.datasetname_data_source import DatasetnameDataSource
+from delphi.nowcast_datasetname.util.datasetname_data_source import DatasetnameDataSource, get_ground_truth
 from delphi.nowcast_datasetname.util.sensors_table import SensorsTable
 import delphi.operations.secrets as secrets
 from delphi.utils.epidate import EpiDate
 import delphi.utils.epiweek as flu
 from delphi.utils.geo.locations import Locations
 
+# memoized epiweek arithmetic; the same epiweeks recur across sensors and locations
+_delta_epiweeks = functools.lru_cache(maxsize=4096)(flu.delta_epiweeks)
+
 """
 Suggestions:
 1. add paramters for functions (such as fit_loch_ness) which can specify "flu" or "datasetname" or other kinds of data
@@ -52,24 +56,47 @@ Suggestions:
 """
 
 
+def select_weeks(rows, weeks):
+  """Return the rows within the given range of epiweeks."""
+  return [row for row in rows if weeks['from'] <= row['epiweek'] <= weeks['to']]
+
+
 class SignalGetter:
   """Class with static methods that implement the fetching of
   different data signals. Each function returns a function that
   only takes a single argument:
   - weeks: an Epiweek range of weeks to fetch data for.
+  The returned function gives the (checked) rows of the API response. The
+  entire history of each signal is fetched once and cached, and the rows
+  within the given weeks are selected from it, so the rows must not be
+  modified.
   """
   def __init__(self):
     pass
 
+  @staticmethod
+  @functools.lru_cache(maxsize=64)
+  def fetch_ght(loc):
+    weeks = Epidata.range(199301, EpiDate.today().get_ew())
+    return Epidata.check(Epidata.ght(secrets.api.ght, loc, weeks, 'datasetname'))
+
+  @staticmethod
+  @functools.lru_cache(maxsize=64)
+  def fetch_datasetnamestat_norsdashboard(target, location):
+    weeks = Epidata.range(199301, EpiDate.today().get_ew())
+    auth = secrets.api.datasetnamestat_norsdashboard
+    return Epidata.check(Epidata.datasetnamestat_norsdashboard(auth, target, location, weeks))
+
   @staticmethod
   def get_ght(location, epiweek, valid):
     loc = 'US' if location == 'nat' else location
-    fetch = lambda weeks: Epidata.ght(secrets.api.ght, loc, weeks, 'datasetname')
+    fetch = lambda weeks: select_weeks(SignalGetter.fetch_ght(loc), weeks)
     return fetch
 
   @staticmethod
   def get_datasetnamestat_norsdashboard(location, epiweek, valid, target):
-    fetch = lambda weeks: Epidata.datasetnamestat_norsdashboard(secrets.api.datasetnamestat_norsdashboard, target, location, weeks)
+    fetch = lambda weeks: select_weeks(
+      SignalGetter.fetch_datasetnamestat_norsdashboard(target, location), weeks)
     return fetch
 
 
@@ -91,10 +118,13 @@ class SensorFitting:
       return (ew1, ew2, ew3, weeks0, weeks1)
 
     def extract(rows, fields, signal_to_truth_ew_shift):
-      data = {}
-      for row in rows:
-        data[flu.add_epiweeks(row['epiweek'], signal_to_truth_ew_shift)] = [float(row[f]) for f in fields]
-      return data
+      # convert all values at once; each value in the returned dict is a row
+      # (a view) of the resulting array
+      epiweeks = [flu.add_epiweeks(row['epiweek'], signal_to_truth_ew_shift) for row in rows]
+      values = np.array([[row[f] for f in fields] for row in rows], dtype=np.float64)
+      if not np.all(np.isfinite(values)):
+        raise Exception('%s has missing or non-finite values' % name)
+      return dict(zip(epiweeks, values))
 
     def get_training_set_data(data):
       epiweeks = sorted(list(data.keys()))
@@ -104,11 +134,11 @@ class SensorFitting:
 
     def get_training_set_datasetname(location, epiweek, signal, target, signal_to_truth_ew_shift):
       ew1, ew2, ew3, weeks0, weeks1 = get_weeks(epiweek)
-      groundTruth = dict()
-      auth = secrets.api.datasetname_targets
-      datasetnameData = Epidata.check(Epidata.datasetname_targets(auth, target, location, weeks0))
-      for row in datasetnameData:
-        groundTruth[row['epiweek']] = row['value']
+      groundTruth = {
+        ew: value
+        for ew, value in get_ground_truth(target, location).items()
+        if weeks0['from'] <= ew <= weeks0['to']
+      }
       data = {}
       dropped_weeks = 0
       for signal_week in signal.keys():
@@ -127,8 +157,8 @@ class SensorFitting:
         msg = 'warning: dropped %d/%d signal weeks because ground truth / target was unavailable'
         print(msg % (dropped_weeks, len(signal)))
       epiweeks = sorted(list(data.keys()))
-      X = [data[week]['x'] for week in epiweeks]
-      Y = [data[week]['y'] for week in epiweeks]
+      X = np.array([data[week]['x'] for week in epiweeks], dtype=np.float64)
+      Y = np.fromiter((data[week]['y'] for week in epiweeks), dtype=np.float64, count=len(epiweeks))
       return (epiweeks, X, Y)
 
     def dot(*Ms):
@@ -140,66 +170,73 @@ class SensorFitting:
         N = np.dot(N, M)
       return N
 
-    def get_weight(ew1, ew2):
-      """ This function gives the weight between two given
-      epiweeks based on a function that:
+    def get_weights(epiweeks, ew2):
+      """ This function gives the weights between each of the
+      given epiweeks and another epiweek based on a function that:
         - drops sharply over the most recent ~3 weeks
         - falls off exponentially with time
         - puts extra emphasis on the past weeks at the
           same time of year (seasonality)
         - gives no week a weight of zero
       """
-      dw = flu.delta_epiweeks(ew1, ew2)
+      dw = np.fromiter(
+        (flu.delta_epiweeks(ew1, ew2) for ew1 in epiweeks),
+        dtype=np.float64, count=len(epiweeks))
       yr = 52.2
       hl1, hl2, bw = yr, 1, 4
       a = 0.05
       # b = (np.cos(2 * np.pi * (dw / yr)) + 1) / 2
-      b = np.exp(-((min(dw % yr, yr - dw % yr) / bw) ** 2))
-      c = 2 ** -(dw / hl1)
-      d = 1 - 2 ** -(dw / hl2)
+      b = np.exp(-((np.minimum(dw % yr, yr - dw % yr) / bw) ** 2))
+      c = np.exp2(-(dw / hl1))
+      d = 1 - np.exp2(-(dw / hl2))
       return (a + (1 - a) * b) * c * d
 
-    def get_periodic_bias(epiweek):
+    def get_periodic_bias(epiweeks):
       weeks_per_year = 52.2
-      offset = flu.delta_epiweeks(200001, epiweek) % weeks_per_year
+      deltas = np.fromiter(
+        (_delta_epiweeks(200001, ew) for ew in epiweeks),
+        dtype=np.float64, count=len(epiweeks))
+      offset = deltas % weeks_per_year
       angle = np.pi * 2 * offset / weeks_per_year
-      return [np.sin(angle), np.cos(angle)]
+      return np.column_stack((np.sin(angle), np.cos(angle)))
 
     def apply_model(epiweek, beta, values):
       bias0 = [1.]
       if beta.shape[0] > len(values) + 1:
         # constant and periodic bias
-        bias1 = get_periodic_bias(epiweek)
-        obs = np.array([values + bias0 + bias1])
+        bias1 = get_periodic_bias([epiweek])[0]
+        obs = np.concatenate((values, bias0, bias1))[None, :]
       else:
         # constant bias only
-        obs = np.array([values + bias0])
+        obs = np.concatenate((values, bias0))[None, :]
       return float(dot(obs, beta))
 
     def get_model(ew2, epiweeks, X, Y):
       ne, nx1, nx2, ny = len(epiweeks), len(X), len(X[0]), len(Y)
       if ne != nx1 or nx1 != ny:
         raise Exception('length mismatch e=%d X=%d Y=%d' % (ne, nx1, ny))
-      weights = np.diag([get_weight(ew1, ew2) for ew1 in epiweeks])
-      X = np.array(X).reshape((nx1, nx2))
-      Y = np.array(Y).reshape((ny, 1))
+      weights = get_weights(epiweeks, ew2)
+      X = np.asarray(X, dtype=np.float64).reshape((nx1, nx2))
+      Y = np.asarray(Y, dtype=np.float64).reshape((ny, 1))
       bias0 = np.ones(Y.shape)
       if ne >= 26 and flu.delta_epiweeks(epiweeks[0], epiweeks[-1]) >= 52:
         # constant and periodic bias
-        bias1 = np.array([get_periodic_bias(ew) for ew in epiweeks])
+        bias1 = get_periodic_bias(epiweeks)
         X = np.hstack((X, bias0, bias1))
       else:
         # constant bias only
         X = np.hstack((X, bias0))
-      XtXi = np.linalg.inv(dot(X.T, weights, X))
-      XtY = dot(X.T, weights, Y)
-      return np.dot(XtXi, XtY)
+      # scale rows by their weights rather than forming the diagonal matrix
+      Xw = X * weights[:, None]
+      XtX = np.dot(Xw.T, X)
+      XtY = np.dot(Xw.T, Y)
+      return np.linalg.solve(XtX, XtY)
 
     if type(fields) == str:
       fields = [fields]
 
     ew1, ew2, ew3, weeks0, weeks1 = get_weeks(epiweek)
-    rows = Epidata.check(fetch(weeks1))
+    rows = fetch(weeks1)
     signal = extract(rows, fields, signal_to_truth_ew_shift)
     # rule of thumb: require num training instances >= 10x num features and >= 52
     min_rows = max(10*len(fields), 52)
@@ -235,6 +272,19 @@ def get_location_list(loc: str):
     raise UnknownLocationException('unknown location: %s' % str(loc))
 
 
+@functools.lru_cache(maxsize=64)
+def get_isch_instance(location, target):
+  """
+  Return a (cached) ISCH instance for the given location and target.
+
+  Constructing an instance fetches and indexes the entire history of the
+  target, which does not depend on the epiweek being predicted. Since the model
+  is retrained for each prediction, instances can be reused across epiweeks.
+  Call `get_isch_instance.cache_clear()` to force a refetch.
+  """
+  return ISCH(location, target)
+
+
 class SensorGetter:
   """Class that implements different sensors. Some sensors
   may take in a signal to do the fitting on, others do not.
@@ -254,7 +304,7 @@ class SensorGetter:
 
   @staticmethod
   def get_isch(location, epiweek, valid, target):
-    return ISCH(location, target).predict(epiweek, valid=valid)
+    return get_isch_instance(location, target).predict(epiweek, valid=valid)
 
   # sensors using the loch ness fitting
 
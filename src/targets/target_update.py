@@ -20,6 +20,10 @@ currently, the only target is a little more complicated:
   + "per2": refers to modified percentage
 """
 
+# standard library
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+
 # third party
 import pandas as pd
 import mysql.connector
@@ -29,34 +33,46 @@ from delphi.epidata.client.delphi_epidata import Epidata
 import delphi.operations.secrets as secrets
 from delphi.utils.epidate import EpiDate
 
+# number of concurrent requests to make to the Epidata API
+MAX_FETCH_WORKERS = 16
+
+# number of rows to write to the database per INSERT statement (the client
+# rewrites placeholders with a regex whose cost grows quadratically with the
+# statement length, so keep prepared statements small)
+INSERT_CHUNK_SIZE = 1000
+
+# IMPL: list the fields of the data source that are used to calculate targets
+EPIDATA_COLUMNS = ('epiweek', 'location', 'rate')
+
+def get_location_df(location_data):
+  """Return a DataFrame with the used columns of the given Epidata rows."""
+  return pd.DataFrame({col: [row[col] for row in location_data] for col in EPIDATA_COLUMNS})
+
 def main():
   print('Reading in data and calculating targets...')
   # Load entire data set, adding 1 location at a time:
   # - first, get all locations from metadata:
   datasetname_info = Epidata.check(Epidata.meta_datasetname(secrets.api.datasetname))
   locations = [row['location'] for row in datasetname_info['locations']]
-  # - now iterate through the locations and add the data:
-  datasetname_df = None
-  for location in locations:
-    location_data = Epidata.check(Epidata.datasetname(secrets.api.datasetname, location, Epidata.range(123412, EpiDate.today().get_ew())))
-    location_df = pd.DataFrame(location_data)
-    if datasetname_df is None:
-      datasetname_df = location_df
-    else:
-      datasetname_df = pd.concat([datasetname_df, location_df], copy=False)
+  # - now fetch the data for all locations (concurrently, since each request is
+  #   dominated by network latency):
+  week_range = Epidata.range(123412, EpiDate.today().get_ew())
+  fetch = lambda location: Epidata.check(Epidata.datasetname(secrets.api.datasetname, location, week_range))
+  with ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as executor:
+    location_dfs = [get_location_df(location_data) for location_data in executor.map(fetch, locations)]
+  # - concatenate once at the end rather than re-copying the running total:
+  datasetname_df = pd.concat(location_dfs, ignore_index=True, copy=False)
   # Prepare the target values:
-  target_df = (
-    datasetname_df
-    # IMPL: transform data into target values here, e.g., preparing rate estimates from counts, etc.
-    .assign(
-      target = 'datasetname_rate', # name/label for the target
-      value = lambda df: df['rate']
-    )
+  # (built in a single pass from the underlying arrays, with only the desired
+  # columns)
+  target_df = pd.DataFrame({
+    'target': 'datasetname_rate', # name/label for the target
+    'epiweek': datasetname_df['epiweek'].to_numpy(),
     # lowercase location to match delphi-epidata codes:
-    .assign(location = lambda df: df['location'].str.lower())
-    # restrict to desired columns:
-    [['target','epiweek','location','value']]
-  )
+    'location': datasetname_df['location'].str.lower().to_numpy(),
+    # IMPL: transform data into target values here, e.g., preparing rate estimates from counts, etc.
+    'value': datasetname_df['rate'].to_numpy(),
+  })
   print('Target values calculated.  Recording in database...')
   # Add to database:
   (u, p) = secrets.db.epi
@@ -80,13 +96,30 @@ def main():
 
       );
     ''')
-    cursor.executemany('''
+    ## (with uniform column dtypes, to_numpy on these mixed columns gives an
+    ## object array of native Python ints, floats, and strs, which the
+    ## connector does not need to convert further)
+    rows = (
+      target_df[['target','epiweek','location','value']]
+      .astype({'epiweek': 'int64', 'value': 'float64'})
+      .to_numpy()
+      .tolist()
+    )
+    ## write rows in chunks, using one multi-row INSERT statement per chunk;
+    ## the statement is prepared server-side, and since only the final chunk
+    ## can be shorter, it is prepared at most twice:
+    insert_sql = lambda num_rows: '''
       INSERT INTO `datasetname_targets` (`target`, `epiweek`, `location`, `value`)
-      VALUES (%s, %s, %s, %s)
-      ON DUPLICATE KEY UPDATE `target`=VALUES(`target`), `epiweek`=VALUES(`epiweek`), `location`=VALUES(`location`), `value`=VALUES(`value`)
-    ''', [(target, epiweek, location, value) for
-          (target, epiweek, location, value) in target_df[['target','epiweek','location','value']].itertuples(index=False, name=None)
-    ])
+      VALUES {}
+      ON DUPLICATE KEY UPDATE `value`=VALUES(`value`)
+    '''.format(', '.join(['(%s, %s, %s, %s)'] * num_rows))
+    full_chunk_sql = insert_sql(INSERT_CHUNK_SIZE)
+    insert_cursor = cnx.cursor(prepared=True)
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+      chunk = rows[start:start + INSERT_CHUNK_SIZE]
+      sql = full_chunk_sql if len(chunk) == INSERT_CHUNK_SIZE else insert_sql(len(chunk))
+      insert_cursor.execute(sql, list(itertools.chain.from_iterable(chunk)))
+    ## commit all chunks as a single transaction:
     cnx.commit()
     print('Successfully recorded target data.')
   finally:
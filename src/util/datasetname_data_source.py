@@ -9,7 +9,11 @@ extensively to reduce the number of requests made to the API.
 
 
 # standard library
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import functools
+import logging
+import os
+import pickle
 
 # first party
 from delphi.epidata.client.delphi_epidata import Epidata
@@ -19,6 +23,30 @@ from delphi.utils.epidate import EpiDate
 from delphi.utils.epiweek import add_epiweeks, range_epiweeks
 from delphi.utils.geo.locations import Locations
 
+logger = logging.getLogger(__name__)
+
+# number of concurrent requests to make to the Epidata API when prefetching
+MAX_FETCH_WORKERS = 16
+
+# sentinel for values that have not been fetched (as opposed to `None`, for
+# values that were fetched but are unavailable)
+MISSING = object()
+
+
+@functools.lru_cache(maxsize=64)
+def get_ground_truth(target, location):
+  """
+  Return a (cached) map from epiweek to target value for the given target and
+  location, over all weeks up to the current week.
+
+  The target table is static, so a single fetch can be shared by all sensors
+  and training weeks; callers select the weeks they need.
+  """
+  auth = secrets.api.datasetname_targets
+  weeks = Epidata.range(199301, EpiDate.today().get_ew())
+  rows = Epidata.check(Epidata.datasetname_targets(auth, target, location, weeks))
+  return {row['epiweek']: row['value'] for row in rows}
+
 
 class DatasetnameDataSource(DataSource):
   """The interface by which all input data is provided."""
@@ -44,102 +72,137 @@ class DatasetnameDataSource(DataSource):
   SENSORS = ['ght', 'nsnd4', 'nsnd7', 'isch']
 
   @staticmethod
-  def new_instance(target):
-    return DatasetnameDataSource(Epidata, DatasetnameDataSource.SENSORS, DatasetnameDataSource.SENSOR_LOCATIONS, target)
+  def new_instance(target, cache_dir=None):
+    return DatasetnameDataSource(Epidata, DatasetnameDataSource.SENSORS, DatasetnameDataSource.SENSOR_LOCATIONS, target, cache_dir)
 
-  def __init__(self, epidata, sensors, locations, target):
+  def __init__(self, epidata, sensors, locations, target, cache_dir=None):
+    """
+    If `cache_dir` is given, prefetched data is saved to (and, on subsequent
+    prefetches of the same weeks, loaded from) files in that directory instead
+    of being fetched from the API every time. This is intended for development
+    and repeated experiments; stale files must be deleted manually.
+    """
     self.epidata = epidata
     self.sensors = sensors
     self.sensor_locations = locations
     self.target = target
-    # cache for prefetching bulk datasetname data
+    self.cache_dir = cache_dir
+    # cache for prefetching bulk datasetname data, keyed by
+    # (name, target, location, epiweek)
     self.cache = {}
+    # the epiweek through which each (name, target, location) was prefetched;
+    # uncached values within these ranges are known to be unavailable
+    self.prefetched = {}
+    # index of the locations with available ground truth on each epiweek
+    self.reporting = {}
+    # lazily computed results of `get_weeks` and `get_missing_locations`
+    self.weeks = None
+    self.missing_locations = {}
 
-  @functools.lru_cache(maxsize=1)
   def get_truth_locations(self):
     """Return a list of locations in which ground truth is available."""
     return self.TARGET_LOCATIONS
 
-  @functools.lru_cache(maxsize=1)
   def get_sensor_locations(self):
     """Return a list of locations in which sensors are available."""
     return self.SENSOR_LOCATIONS
 
-  @functools.lru_cache(maxsize=None)
   def get_missing_locations(self, epiweek):
     """Return a tuple of locations which did not report on the given week."""
+    if epiweek not in self.missing_locations:
+      self.missing_locations[epiweek] = self._get_missing_locations(epiweek)
+    return self.missing_locations[epiweek]
+
+  def _get_missing_locations(self, epiweek):
+    """Determine the missing locations; see `get_missing_locations`."""
 
     # only return missing atoms, i.e. locations that can't be further split
     atomic_locations = set(DatasetnameDataSource.ATOMIC_LOCATIONS)
 
-    available_locations = []
+    # fetch ground truth that isn't already known (i.e. wasn't prefetched)
     for loc in atomic_locations:
-      if self.get_truth_value(epiweek, loc) is None:
-        # this atomic location didn't report (or it's a future week)
-        continue
-      available_locations.append(loc)
+      if self.get_cached_value('datasetname_targets', loc, epiweek) is MISSING:
+        self.get_truth_value(epiweek, loc)
+
+    # atomic locations that didn't report (or it's a future week) are missing
+    available_locations = self.reporting.get(epiweek, set()) & atomic_locations
 
     if available_locations:
       # return tuple(atomic_locations - set(available_locations + ['pr','vi','ny']))
-      return tuple(atomic_locations - set(available_locations))
+      return tuple(atomic_locations - available_locations)
     else:
       # no data is available, assume that all locations will be reporting
       return ()
 
-  @functools.lru_cache(maxsize=1)
   def get_sensors(self):
     """Return a list of sensor names."""
     return self.sensors
 
-  @functools.lru_cache(maxsize=1)
   def get_weeks(self):
-    """Return a list of weeks on which truth and sensors are both available."""
-    week_range = range_epiweeks(
-        self.FIRST_DATA_EPIWEEK, self.LAST_DATA_EPIWEEK, inclusive=True)
-    return list(week_range)
+    """
+    Return a (cached) tuple of weeks on which truth and sensors are both
+    available.
+    """
+    if self.weeks is None:
+      self.weeks = tuple(range_epiweeks(
+          self.FIRST_DATA_EPIWEEK, self.LAST_DATA_EPIWEEK, inclusive=True))
+    return self.weeks
 
   def get_truth_value(self, epiweek, location):
     """Return ground truth / target data"""
-    try:
-      return self.cache['datasetname_targets'][self.target][location][epiweek]
-    except KeyError:
-      print('cache miss: get_truth_value', epiweek, location)
-      auth = secrets.api.datasetname_targets
-      response = self.epidata.datasetname_targets(auth, self.target, location, epiweek)
-      if response['result'] != 1:
-        return self.add_to_cache('datasetname_targets', self.target, location, epiweek, None)
-      data = response['epidata'][0]
-      return self.add_to_cache('datasetname_targets', self.target, location, epiweek, data['value'])
-
-  @functools.lru_cache(maxsize=None)
+    value = self.get_cached_value('datasetname_targets', location, epiweek)
+    if value is not MISSING:
+      return value
+    logger.debug('cache miss: get_truth_value %s %s', epiweek, location)
+    auth = secrets.api.datasetname_targets
+    response = self.epidata.datasetname_targets(auth, self.target, location, epiweek)
+    if response['result'] != 1:
+      return self.add_to_cache('datasetname_targets', self.target, location, epiweek, None)
+    data = response['epidata'][0]
+    return self.add_to_cache('datasetname_targets', self.target, location, epiweek, data['value'])
+
   def get_sensor_value(self, epiweek, location, name):
     """Return a sensor reading."""
 
-    try:
-      return self.cache[name][self.target][location][epiweek]
-    except KeyError:
-      print('cache miss: get_sensor_value', epiweek, location, name)
-      response = self.epidata.datasetname_sensors(secrets.api.datasetname_sensors,
+    value = self.get_cached_value(name, location, epiweek)
+    if value is not MISSING:
+      return value
+    logger.debug('cache miss: get_sensor_value %s %s %s', epiweek, location, name)
+    response = self.epidata.datasetname_sensors(secrets.api.datasetname_sensors,
                                                 self.target, name, location, epiweek)
-      if response['result'] != 1:
-        return self.add_to_cache(name, self.target, location, epiweek, None)
-      value = response['epidata'][0]['value']
-      return self.add_to_cache(name, self.target, location, epiweek, value)
+    if response['result'] != 1:
+      return self.add_to_cache(name, self.target, location, epiweek, None)
+    value = response['epidata'][0]['value']
+    return self.add_to_cache(name, self.target, location, epiweek, value)
 
-  @functools.lru_cache(maxsize=1)
   def get_most_recent_issue(self):
     """Return the most recent epiweek for which ground truth / target data is available."""
     return self.LAST_DATA_EPIWEEK
 
+  def get_cached_value(self, name, location, epiweek):
+    """
+    Return the cached value for the current target, or `MISSING` if the value
+    has not been fetched.
+    """
+    key = (name, self.target, location, epiweek)
+    if key in self.cache:
+      return self.cache[key]
+    last_week = self.prefetched.get((name, self.target, location))
+    if last_week is not None:
+      if self.FIRST_DATA_EPIWEEK <= epiweek <= last_week:
+        # prefetched, but not reported
+        return None
+    return MISSING
+
   def add_to_cache(self, name, target, location, epiweek, value):
     """Add the given value to the cache."""
-    if name not in self.cache:
-      self.cache[name] = {}
-    if target not in self.cache[name]:
-      self.cache[name][target] = {}
-    if location not in self.cache[name][target]:
-      self.cache[name][target][location] = {}
-    self.cache[name][target][location][epiweek] = value
+    self.cache[(name, target, location, epiweek)] = value
+    if name == 'datasetname_targets' and target == self.target:
+      reporting = self.reporting.setdefault(epiweek, set())
+      if value is None:
+        reporting.discard(location)
+      else:
+        reporting.add(location)
     return value
 
   def prefetch(self, epiweek):
@@ -147,39 +210,113 @@ class DatasetnameDataSource(DataSource):
     Fetch all data in all locations up to the given epiweek.
 
     Requests are batched. This is significantly more efficient (and faster)
-    than querying each sensor/location/epiweek data point individually.
+    than querying each sensor/location/epiweek data point individually. The
+    batched requests are independent, so they are made concurrently.
     """
 
+    # resolve credentials and API methods once, rather than in every request
+    auth_targets = secrets.api.datasetname_targets
+    auth_sensors = secrets.api.datasetname_sensors
+    check = self.epidata.check
+    datasetname_targets = self.epidata.datasetname_targets
+    datasetname_sensors = self.epidata.datasetname_sensors
+    target = self.target
+
     def extract(response):
       if response['result'] == -2:
         return []
-      return self.epidata.check(response)
+      return check(response)
+
+    def fetch_truth(loc):
+      return check(datasetname_targets(auth_targets, target, loc, weeks))
+
+    def fetch_sensor(loc, sen):
+      return extract(datasetname_sensors(auth_sensors, target, sen, loc, weeks))
+
+    if self.cache_dir is not None and self.load_prefetched(epiweek):
+      return
 
     weeks = Epidata.range(self.FIRST_DATA_EPIWEEK, epiweek)
+    sensors = tuple(self.get_sensors())
+    truth_locations = self.get_truth_locations()
     sensor_locations = set(self.get_sensor_locations())
-
-    # loop over locations to avoid hitting the limit of ~3.5k rows
-    for loc in self.get_truth_locations():
-      print('fetching %s...' % loc)
-
-      # default to None to prevent cache misses on missing values
-      for week in range_epiweeks(self.FIRST_DATA_EPIWEEK, epiweek, inclusive=True):
-        for name in ['datasetname_targets'] + self.get_sensors():
-          self.add_to_cache(name, self.target, loc, week, None)
-
-      # ground truth
-      auth = secrets.api.datasetname_targets
-      datasetnameData = self.epidata.check(self.epidata.datasetname_targets(auth, self.target, loc, weeks))
-      for row in datasetnameData:
-        self.add_to_cache('datasetname_targets', self.target, loc, row['epiweek'], row['value'])
-
-      # sensor readings
-      if loc not in sensor_locations:
-        # skip withheld locations (i.e. a retrospective experiment)
-        continue
-      for sen in self.get_sensors():
-        response = self.epidata.datasetname_sensors(
-          secrets.api.datasetname_sensors, self.target, sen, loc, weeks
-        )
-        for row in extract(response):
-          self.add_to_cache(sen, self.target, loc, row['epiweek'], row['value'])
+    add_to_cache = self.add_to_cache
+
+    # record the prefetched range to prevent cache misses on missing values
+    names = ('datasetname_targets',) + sensors
+    self.prefetched.update({
+      (name, target, loc): epiweek
+      for loc in truth_locations
+      for name in names
+    })
+
+    # request each location separately to avoid hitting the limit of ~3.5k rows
+    with ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as executor:
+      futures = {}
+      for loc in truth_locations:
+        # ground truth
+        futures[executor.submit(fetch_truth, loc)] = ('datasetname_targets', loc)
+
+        # sensor readings
+        if loc not in sensor_locations:
+          # skip withheld locations (i.e. a retrospective experiment)
+          continue
+        for sen in sensors:
+          futures[executor.submit(fetch_sensor, loc, sen)] = (sen, loc)
+
+      for future in as_completed(futures):
+        name, loc = futures[future]
+        logger.debug('fetched %s %s', name, loc)
+        for row in future.result():
+          add_to_cache(name, target, loc, row['epiweek'], row['value'])
+
+    if self.cache_dir is not None:
+      self.save_prefetched(epiweek)
+
+  def get_prefetch_file(self, epiweek):
+    """Return the path of the file holding data prefetched up to the epiweek."""
+    filename = '%s_%d_%d.pkl' % (self.target, self.FIRST_DATA_EPIWEEK, epiweek)
+    return os.path.join(os.path.expanduser(self.cache_dir), filename)
+
+  def get_prefetch_config(self):
+    """Return the settings which determine what `prefetch` fetches."""
+    return (
+      list(self.get_sensors()),
+      list(self.get_truth_locations()),
+      list(self.get_sensor_locations()),
+    )
+
+  def save_prefetched(self, epiweek):
+    """Save the cache to the prefetch file for the given epiweek."""
+    path = self.get_prefetch_file(epiweek)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    state = {
+      'config': self.get_prefetch_config(),
+      'cache': self.cache,
+      'prefetched': self.prefetched,
+      'reporting': self.reporting,
+    }
+    # write to a temporary file first so that readers never see partial files
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as f:
+      pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+  def load_prefetched(self, epiweek):
+    """
+    Load the cache from the prefetch file for the given epiweek. Return True if
+    the file existed and was prefetched with the same settings, else False.
+    """
+    path = self.get_prefetch_file(epiweek)
+    if not os.path.exists(path):
+      return False
+    with open(path, 'rb') as f:
+      state = pickle.load(f)
+    if state['config'] != self.get_prefetch_config():
+      logger.debug('ignoring prefetch file with different settings: %s', path)
+      return False
+    self.cache.update(state['cache'])
+    self.prefetched.update(state['prefetched'])
+    for week, locations in state['reporting'].items():
+      self.reporting.setdefault(week, set()).update(locations)
+    return True
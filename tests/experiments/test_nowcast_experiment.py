@@ -73,6 +73,11 @@ class UnitTests(unittest.TestCase):
     self.assertIsInstance(data_source, DatasetnameDataSource)
     self.assertIsInstance(nowcast, Nowcast)
 
+    # target and cache directory are passed to the data source
+    data_source = provider.get_data_source(None, None, None, 'tar', 'cache')
+    self.assertEqual(data_source.target, 'tar')
+    self.assertEqual(data_source.cache_dir, 'cache')
+
   def test_get_locations_at_resolution(self):
     """Return locations needed for abscission experiments."""
 
@@ -260,16 +265,21 @@ class UnitTests(unittest.TestCase):
     args = ['filename'] + [None] * 4 + [True]
     all_weeks = list(range(10))
     self.mock_data_source.get_weeks.return_value = all_weeks
-    self.experiment.run_experiment(*args)
+    self.mock_data_source.target = 'tar'
+    experiment = NowcastExperiment(
+        self.mock_provider, self.mock_epidata, self.mock_data_source, 'cache')
+    experiment.run_experiment(*args)
 
     self.assertTrue(self.mock_data_source.get_weeks.called)
 
     self.assertTrue(self.mock_provider.get_data_source.called)
     args, kwargs = self.mock_provider.get_data_source.call_args
-    self.assertEqual(len(args), 3)
+    self.assertEqual(len(args), 4)
     self.assertEqual(args[0], self.mock_epidata)
     self.assertIn('ght', args[1])
     self.assertIn('ca', args[2])
+    self.assertEqual(args[3], 'tar')
+    self.assertEqual(kwargs, {'cache_dir': 'cache'})
     data_source = self.mock_provider.get_data_source()
 
     self.assertTrue(self.mock_provider.get_nowcast.called)
@@ -0,0 +1,123 @@
+"""Unit tests for datasetname_location_mapper.py."""
+
+# standard library
+from fractions import Fraction
+import unittest
+
+# first party
+from delphi.nowcast_datasetname.util.datasetname_data_source import DatasetnameDataSource
+from delphi.utils.geo.locations import Locations
+
+# py3tester coverage target
+__test_target__ = 'delphi.nowcast_datasetname.fusion.datasetname_location_mapper'
+
+
+class UnitTests(unittest.TestCase):
+  """Basic unit tests."""
+
+  def setUp(self):
+    self.atoms = tuple(DatasetnameDataSource.ATOMIC_LOCATIONS)
+
+  def test_get_weight_row(self):
+    # single atom
+    weights = DatasetnameLocationMapper.get_weight_row('ca', None, self.atoms)
+    self.assertEqual(len(weights), len(self.atoms))
+    self.assertEqual(sum(weights), 1)
+    for w in weights:
+      self.assertTrue(isinstance(w, Fraction))
+      self.assertTrue(w in (0, 1))
+    self.assertEqual(weights[self.atoms.index('ca')], 1)
+
+    # some atoms
+    weights = DatasetnameLocationMapper.get_weight_row('hhs1', None, self.atoms)
+    self.assertEqual(sum(weights), 1)
+    for w in weights:
+      self.assertTrue(isinstance(w, Fraction))
+      self.assertTrue(0 <= w < 1)
+
+    # all atoms
+    weights = DatasetnameLocationMapper.get_weight_row('nat', None, self.atoms)
+    self.assertEqual(sum(weights), 1)
+    for w in weights:
+      self.assertTrue(isinstance(w, Fraction))
+      self.assertTrue(0 < w < 1)
+
+  def test_ny_components(self):
+    # 'ny' is an atom here, but its population is given by its components
+    weights = DatasetnameLocationMapper.get_weight_row('ny', None, self.atoms)
+    self.assertEqual(weights[self.atoms.index('ny')], 1)
+    self.assertEqual(sum(weights), 1)
+
+    # 'ny' has the combined population of its components within a region
+    atoms = ('nj', 'ny')
+    weights = DatasetnameLocationMapper.get_weight_row('hhs2', None, atoms)
+    ny = get_population('ny_minus_jfk') + get_population('jfk')
+    nj = get_population('nj')
+    self.assertEqual(weights, [Fraction(nj, nj + ny), Fraction(ny, nj + ny)])
+
+    # the components themselves are not atoms
+    with self.assertRaises(Exception):
+      DatasetnameLocationMapper.get_weight_row('jfk', None, ('nj',))
+
+  def test_get_weight_matrix(self):
+    locations = ('nat', 'hhs1', 'hhs2', 'ca', 'ny', 'pr')
+    n, m = len(locations), len(self.atoms)
+
+    # float weights (default)
+    W = DatasetnameLocationMapper.get_weight_matrix(locations, None, self.atoms)
+    self.assertEqual(W.shape, (n, m))
+    self.assertEqual(W.dtype, np.float64)
+    self.assertTrue(np.allclose(np.sum(W, axis=1), 1))
+
+    # exact weights
+    W_exact = DatasetnameLocationMapper.get_weight_matrix(
+        locations, None, self.atoms, exact=True)
+    self.assertEqual(W_exact.shape, (n, m))
+    for row in W_exact:
+      self.assertEqual(sum(row), 1)
+      for w in row:
+        self.assertTrue(isinstance(w, Fraction))
+
+    # exact and float weights agree
+    self.assertTrue(np.allclose(W_exact.astype(np.float64), W))
+
+    # retrospective weights also agree
+    W = DatasetnameLocationMapper.get_weight_matrix(locations, 2016, self.atoms)
+    W_exact = DatasetnameLocationMapper.get_weight_matrix(
+        locations, 2016, self.atoms, exact=True)
+    self.assertTrue(np.allclose(W_exact.astype(np.float64), W))
+
+    # single atom, non-matching
+    with self.assertRaises(Exception):
+      DatasetnameLocationMapper.get_weight_matrix(('pa',), None, ('ga',))
+
+  def test_determine_statespace(self):
+    data_source = DatasetnameDataSource
+    determine = lambda inputs: DatasetnameLocationMapper.determine_statespace(
+        inputs, data_source)
+
+    # all atoms and a subset of atoms (i.e. with and without the shortcut)
+    for inputs in (self.atoms, self.atoms[::3]):
+      with self.subTest(num_inputs=len(inputs)):
+        H, W, outputs = determine(inputs)
+        self.assertEqual(H.shape[0], len(inputs))
+        self.assertEqual(W.shape[0], len(outputs))
+        self.assertEqual(H.shape[1], W.shape[1])
+
+        # permuted inputs permute the rows of H only
+        permutation = list(range(len(inputs)))[::-1]
+        H2, W2, outputs2 = determine(tuple(inputs[i] for i in permutation))
+        self.assertTrue(np.allclose(H2, H[permutation, :]))
+        self.assertTrue(np.allclose(W2, W))
+        self.assertEqual(outputs2, outputs)
+
+        # duplicated inputs duplicate the rows of H only
+        H3, W3, outputs3 = determine(inputs * 2)
+        self.assertTrue(np.allclose(H3, np.vstack((H, H))))
+        self.assertTrue(np.allclose(W3, W))
+        self.assertEqual(outputs3, outputs)
+
+    # directly exclude an input location
+    with self.assertRaises(Exception):
+      DatasetnameLocationMapper.determine_statespace(
+          self.atoms, data_source, exclude_locations=('ar',))
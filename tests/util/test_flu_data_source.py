@@ -1,6 +1,7 @@
 """Unit tests for flu_data_source.py."""
 
 # standard library
+import tempfile
 import unittest
 from unittest.mock import MagicMock
 
@@ -11,6 +12,59 @@ from delphi.utils.geo.locations import Locations
 # py3tester coverage target
 __test_target__ = 'delphi.nowcast_datasetname.util.datasetname_data_source'
 
+
+class UnitTests(unittest.TestCase):
+  """Basic unit tests."""
+
+  def test_prefetch_missing_values_are_cached(self):
+    """Prefetched weeks without data are unavailable, not cache misses."""
+    epidata = MagicMock()
+    epidata.check.return_value = [{'epiweek': 201813, 'value': 2}]
+    epidata.datasetname_sensors.return_value = {'result': 1}
+    data_source = DatasetnameDataSource(epidata, ['s'], ['ak'], 'tar')
+    data_source.get_truth_locations = lambda *a: ['ak', 'al']
+
+    data_source.prefetch(201813)
+    epidata.datasetname_targets.reset_mock()
+    epidata.datasetname_sensors.reset_mock()
+
+    # cache hit (from prefetch)
+    self.assertEqual(data_source.get_truth_value(201813, 'ak'), 2)
+    self.assertEqual(data_source.get_sensor_value(201813, 'ak', 's'), 2)
+
+    # cache "hit" (not reported, or withheld location)
+    self.assertIsNone(data_source.get_truth_value(201812, 'ak'))
+    self.assertIsNone(data_source.get_sensor_value(201813, 'al', 's'))
+    self.assertEqual(epidata.datasetname_targets.call_count, 0)
+    self.assertEqual(epidata.datasetname_sensors.call_count, 0)
+
+    # cache miss (after the prefetched range)
+    epidata.datasetname_targets.return_value = {'result': -2}
+    self.assertIsNone(data_source.get_truth_value(201814, 'ak'))
+    self.assertEqual(epidata.datasetname_targets.call_count, 1)
+
+  def test_prefetch_from_cache_dir(self):
+    """Prefetched data is reused from the cache directory."""
+    epidata = MagicMock()
+    epidata.check.return_value = [{'epiweek': 201813, 'value': 2}]
+    epidata.datasetname_sensors.return_value = {'result': 1}
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+      new_data_source = lambda: DatasetnameDataSource(
+          epidata, ['s'], ['ak'], 'tar', cache_dir=cache_dir)
+      new_data_source().prefetch(201813)
+      self.assertEqual(epidata.datasetname_targets.call_count, len(DatasetnameDataSource.TARGET_LOCATIONS))
+
+      epidata.reset_mock()
+      data_source = new_data_source()
+      data_source.prefetch(201813)
+      self.assertEqual(epidata.datasetname_targets.call_count, 0)
+      self.assertEqual(epidata.datasetname_sensors.call_count, 0)
+      self.assertEqual(data_source.get_truth_value(201813, 'ak'), 2)
+      self.assertIsNone(data_source.get_truth_value(201812, 'ak'))
+      self.assertEqual(epidata.datasetname_targets.call_count, 0)
+
+
 ## fixme replace tests here
 
 # class UnitTests(unittest.TestCase):